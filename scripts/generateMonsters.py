@@ -5,20 +5,83 @@
     The images are placed in ../cdn/monsters/. This directory is NOT included in the Next.js app bundle, and should
     be deployed separately to our file storage solution.
 
-    Written for Python 3.9.
+    Written for Python 3.11.
 """
+import argparse
+import asyncio
 import os.path
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import urllib.parse
 import re
 import csv
 
+# orjson is considerably faster at parsing the large SMW responses, but fall back to the stdlib if it's unavailable
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Images are downloaded with aiohttp where available, otherwise we fall back to a thread pool using requests
+try:
+    import aiofiles
+    import aiohttp
+except ImportError:
+    aiofiles = None
+    aiohttp = None
+
 FILE_NAME = '../cdn/json/monsters.json'
 WIKI_BASE = 'https://oldschool.runescape.wiki'
 API_BASE = WIKI_BASE + '/api.php'
 IMG_PATH = '../cdn/monsters/'
+# Matches page names outside the main namespace on the wiki (e.g. "Update:...")
+NAMESPACE_RE = re.compile(r'^[A-Za-z]+:')
+# Monsters whose names contain any of these are pruned from the output
+PRUNED_NAME_MARKERS = ('(historical)', '(pvm arena)', '(deadman: apocalypse)')
+
+# Manual patches to the generated data, as (path, value) pairs for each monster.
+# Keyed by (name, version) to patch a single version, or by name alone to patch every version of that monster.
+MONSTER_OVERRIDES = {
+    # Both of the Spinolyp's attacks roll ranged vs ranged.
+    # This "patch" will have to be revisited if/when we add protection prayers.
+    'Spinolyp': (
+        (('style',), ['Ranged']),
+    ),
+}
+
+# Raw SMW results are cached here between runs, so that tweaking the post-processing doesn't require a re-fetch
+WIKI_CACHE_FILE = 'wiki_cache.json'
+WIKI_CACHE_MAX_AGE = 24 * 60 * 60
+HEADERS = {
+    # Accept-Encoding is deliberately left to requests/aiohttp, which already ask for every codec they can decode
+    'User-Agent': 'osrs-dps-calc (https://github.com/weirdgloop/osrs-dps-calc)'
+}
+
+# Safety valve so that a misbehaving SMW query can never paginate forever
+MAX_QUERY_OFFSET = 200000
+
+# Maximum number of image downloads that may be in flight at once
+MAX_CONCURRENT_DOWNLOADS = 32
+# Number of file titles the MediaWiki API will resolve in a single imageinfo query
+IMAGEINFO_BATCH_SIZE = 50
+# Images are streamed to disk in chunks of this many bytes, rather than being held in memory in full
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Retry behaviour for transient wiki failures (rate limiting, 5xx responses, connection errors)
+REQUEST_TIMEOUT = 30
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30
+
+# Shared session, so that connections to the wiki are kept alive and reused between requests
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount('https://', HTTPAdapter(pool_maxsize=MAX_CONCURRENT_DOWNLOADS, pool_block=False))
 
 REQUIRED_PRINTOUTS = [
     'Attack bonus',
@@ -59,7 +122,76 @@ REQUIRED_PRINTOUTS = [
     'Heavy range defence bonus'
 ]
 
+# Mappings of our JSON keys to the SMW printouts that they are read from, for each group of stats
+SKILL_PRINTOUTS = (
+    ('atk', 'Attack level'),
+    ('def', 'Defence level'),
+    ('hp', 'Hitpoints'),
+    ('magic', 'Magic level'),
+    ('ranged', 'Ranged level'),
+    ('str', 'Strength level'),
+)
+OFFENSIVE_PRINTOUTS = (
+    ('atk', 'Attack bonus'),
+    ('magic', 'Magic attack bonus'),
+    ('magic_str', 'Magic Damage bonus'),
+    ('ranged', 'Range attack bonus'),
+    ('ranged_str', 'Ranged Strength bonus'),
+    ('str', 'Strength bonus'),
+)
+DEFENSIVE_PRINTOUTS = (
+    ('crush', 'Crush defence bonus'),
+    ('magic', 'Magic defence bonus'),
+    ('heavy', 'Heavy range defence bonus'),
+    ('standard', 'Standard range defence bonus'),
+    ('light', 'Light range defence bonus'),
+    ('slash', 'Slash defence bonus'),
+    ('stab', 'Stab defence bonus'),
+)
+
+def loads_json(content):
+    return orjson.loads(content) if orjson else json.loads(content)
+
+
+def dumps_json(obj, indent=False):
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode('utf-8')
+
+
+def should_retry(status):
+    return status == 429 or status >= 500
+
+
+def get_retry_delay(attempt, retry_after=None):
+    # Honour the wiki's Retry-After header if it gave us one, otherwise back off exponentially with some jitter
+    if retry_after is not None and retry_after.isdigit():
+        return int(retry_after) + random.uniform(0, RETRY_BASE_DELAY)
+    return min(RETRY_BASE_DELAY * 2 ** attempt * (1 + random.random() * 0.5), RETRY_MAX_DELAY)
+
+
+def get_with_retry(url, stream=False):
+    for attempt in range(MAX_RETRIES):
+        is_last_attempt = attempt == MAX_RETRIES - 1
+        try:
+            r = SESSION.get(url, timeout=REQUEST_TIMEOUT, stream=stream)
+        except requests.exceptions.RequestException as e:
+            if is_last_attempt:
+                raise
+            print(f'Request failed ({e}), retrying: {url}')
+            time.sleep(get_retry_delay(attempt))
+            continue
+
+        if not should_retry(r.status_code) or is_last_attempt:
+            return r
+
+        print(f'Request failed (HTTP {r.status_code}), retrying: {url}')
+        r.close()
+        time.sleep(get_retry_delay(attempt, r.headers.get('Retry-After')))
+
+
 def get_monster_data():
+    # Returns the monsters, and whether the results were fetched in full (i.e. the query ended normally)
     monsters = {}
     offset = 0
     while True:
@@ -69,23 +201,27 @@ def get_monster_data():
             'format': 'json',
             'query': '[[Uses infobox::Monster]]|?' + '|?'.join(REQUIRED_PRINTOUTS) + '|limit=500|offset=' + str(offset)
         }
-        r = requests.get(API_BASE + '?' + urllib.parse.urlencode(query), headers={
-            'User-Agent': 'osrs-dps-calc (https://github.com/weirdgloop/osrs-dps-calc)'
-        })
-        data = r.json()
+        r = get_with_retry(API_BASE + '?' + urllib.parse.urlencode(query))
+        data = loads_json(r.content)
 
         if 'query' not in data or 'results' not in data['query']:
             # No results?
-            break
+            return monsters, False
 
-        monsters = monsters | data['query']['results']
+        monsters.update(data['query']['results'])
 
-        if 'query-continue-offset' not in data or int(data['query-continue-offset']) < offset:
-            # If we are at the end of the results, break out of this loop
-            break
-        else:
-            offset = data['query-continue-offset']
-    return monsters
+        if 'query-continue-offset' not in data:
+            # If we are at the end of the results, we're done
+            return monsters, True
+
+        new_offset = int(data['query-continue-offset'])
+        if new_offset <= offset:
+            print('Query offset stopped advancing - stopping.')
+            return monsters, False
+        if new_offset > MAX_QUERY_OFFSET:
+            print('Reached the maximum query offset - stopping.')
+            return monsters, False
+        offset = new_offset
 
 
 def get_printout_value(prop, all_results=False):
@@ -96,17 +232,147 @@ def get_printout_value(prop, all_results=False):
         return prop if all_results else prop[0]
 
 
+def apply_override(monster, path, value):
+    # Walk down to the parent of the patched field, so that nested values (e.g. a single skill) can be replaced
+    target = monster
+    for key in path[:-1]:
+        target = target[key]
+    target[path[-1]] = value
+
+
 def has_category(category_array, category):
     return next((c for c in category_array if c['fulltext'] == "Category:%s" % category), None)
 
 
+def resolve_image_urls(files):
+    # Look up the direct upload URLs for files in batches, rather than going through the Special:Filepath redirect
+    for i in range(0, len(files), IMAGEINFO_BATCH_SIZE):
+        chunk = files[i:i + IMAGEINFO_BATCH_SIZE]
+        print(f'Resolving image URLs: {i}/{len(files)}')
+        query = {
+            'action': 'query',
+            'format': 'json',
+            'prop': 'imageinfo',
+            'iiprop': 'url',
+            'redirects': 1,
+            'titles': '|'.join('File:' + f for f in chunk)
+        }
+        r = get_with_retry(API_BASE + '?' + urllib.parse.urlencode(query))
+        data = loads_json(r.content).get('query', {})
+
+        # The API normalises titles and follows redirects, so map the returned titles back onto our filenames.
+        # Several of our filenames can end up at the same title (e.g. two redirects to one file), so keep them all.
+        titles = {}
+        for f in chunk:
+            titles.setdefault('File:' + f, []).append(f)
+        for mapping in data.get('normalized', []) + data.get('redirects', []):
+            if mapping['from'] in titles:
+                titles.setdefault(mapping['to'], []).extend(titles[mapping['from']])
+
+        for page in data.get('pages', {}).values():
+            if page.get('imageinfo') and page['title'] in titles:
+                for f in titles[page['title']]:
+                    yield f, page['imageinfo'][0]['url']
+
+
+def discard_failed_image(img):
+    # Don't leave a partially-written image behind from an earlier attempt, otherwise it'll be skipped on the next run
+    dest_path = IMG_PATH + img
+    if os.path.isfile(dest_path):
+        os.remove(dest_path)
+    print('Unable to save image: ' + img)
+    return False
+
+
+async def fetch_image(session, sem, img, url):
+    dest_path = IMG_PATH + img
+    async with sem:
+        for attempt in range(MAX_RETRIES):
+            is_last_attempt = attempt == MAX_RETRIES - 1
+            try:
+                async with session.get(url) as r:
+                    if should_retry(r.status) and not is_last_attempt:
+                        delay = get_retry_delay(attempt, r.headers.get('Retry-After'))
+                    elif r.status != 200:
+                        return discard_failed_image(img)
+                    else:
+                        async with aiofiles.open(dest_path, 'wb') as f:
+                            async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                                await f.write(chunk)
+                        print('Saved image: ' + img)
+                        return True
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if is_last_attempt:
+                    return discard_failed_image(img)
+                delay = get_retry_delay(attempt)
+
+            await asyncio.sleep(delay)
+
+
+async def download_all(img_urls):
+    async with aiohttp.ClientSession(
+        headers=HEADERS,
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    ) as session:
+        sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+        async with asyncio.TaskGroup() as tg:
+            tasks = [tg.create_task(fetch_image(session, sem, img, url)) for img, url in img_urls]
+    return [t.result() for t in tasks]
+
+
+def download_one(img, url):
+    dest_path = IMG_PATH + img
+    try:
+        with get_with_retry(url, stream=True) as r:
+            if r.status_code != 200:
+                return discard_failed_image(img)
+            with open(dest_path, 'wb') as f:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+    except requests.exceptions.RequestException:
+        return discard_failed_image(img)
+
+    print('Saved image: ' + img)
+    return True
+
+
+def download_all_threaded(img_urls):
+    # The worker count matches the SESSION connection pool size, so that urllib3 never has to discard connections
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS) as executor:
+        return list(executor.map(lambda img_url: download_one(*img_url), img_urls))
+
+
+def load_monster_data(refresh=False):
+    if (
+        not refresh
+        and os.path.exists(WIKI_CACHE_FILE)
+        and time.time() - os.path.getmtime(WIKI_CACHE_FILE) < WIKI_CACHE_MAX_AGE
+    ):
+        print('Using cached monster info from: ' + WIKI_CACHE_FILE)
+        with open(WIKI_CACHE_FILE, 'rb') as f:
+            return loads_json(f.read())
+
+    wiki_data, complete = get_monster_data()
+    # Only cache a full set of results, otherwise a single bad fetch would be reused for the lifetime of the cache
+    if wiki_data and complete:
+        with open(WIKI_CACHE_FILE, 'wb') as f:
+            f.write(dumps_json(wiki_data))
+    else:
+        print('Monster info was not fetched in full - not caching it.')
+    return wiki_data
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Generate monsters.json and download monster images from the OSRS Wiki.')
+    parser.add_argument('--refresh', action='store_true', help='ignore the cached wiki data and re-fetch it')
+    args = parser.parse_args()
+
     # Grab the monster info using SMW, including all the relevant printouts
-    wiki_data = get_monster_data()
+    wiki_data = load_monster_data(args.refresh)
 
     # Convert the data into our own JSON structure
     data = []
-    required_imgs = []
+    required_imgs = set()
 
     # Loop over the monsters data from the wiki
     for k, v in wiki_data.items():
@@ -131,7 +397,7 @@ def main():
             continue
 
         # Skip monsters that aren't in the main namespace on the wiki
-        if re.match("^([A-z]*):", k):
+        if NAMESPACE_RE.match(k):
             continue
 
         # Skip "monsters" that are actually non-interactive scenery, or don't exist
@@ -145,11 +411,6 @@ def main():
         if monster_style == 'None' or monster_style == 'N/A':
             monster_style = None
 
-        # Override style specifically for Spinolyps. Both attacks roll ranged vs ranged.
-        # This "patch" will have to be revisited if/when we add protection prayers.
-        if 'Spinolyp' in k:
-            monster_style = ['Ranged']
-
         monster = {
             'id': get_printout_value(po['NPC ID']),
             'name': k.rsplit('#', 1)[0] or '',
@@ -160,34 +421,20 @@ def main():
             'style': monster_style,
             'size': get_printout_value(po['Size']) or 0,
             'max_hit': get_printout_value(po['Max hit']) or 0,
-            'skills': {
-                'atk': get_printout_value(po['Attack level']) or 0,
-                'def': get_printout_value(po['Defence level']) or 0,
-                'hp': get_printout_value(po['Hitpoints']) or 0,
-                'magic': get_printout_value(po['Magic level']) or 0,
-                'ranged': get_printout_value(po['Ranged level']) or 0,
-                'str': get_printout_value(po['Strength level']) or 0
-            },
-            'offensive': {
-                'atk': get_printout_value(po['Attack bonus']) or 0,
-                'magic': get_printout_value(po['Magic attack bonus']) or 0,
-                'magic_str': get_printout_value(po['Magic Damage bonus']) or 0,
-                'ranged': get_printout_value(po['Range attack bonus']) or 0,
-                'ranged_str': get_printout_value(po['Ranged Strength bonus']) or 0,
-                'str': get_printout_value(po['Strength bonus']) or 0
-            },
-            'defensive': {
-                'crush': get_printout_value(po['Crush defence bonus']) or 0,
-                'magic': get_printout_value(po['Magic defence bonus']) or 0,
-                'heavy': get_printout_value(po['Heavy range defence bonus']) or 0,
-                'standard': get_printout_value(po['Standard range defence bonus']) or 0,
-                'light': get_printout_value(po['Light range defence bonus']) or 0,
-                'slash': get_printout_value(po['Slash defence bonus']) or 0,
-                'stab': get_printout_value(po['Stab defence bonus']) or 0
-            },
+            'skills': {key: get_printout_value(po[prop]) or 0 for key, prop in SKILL_PRINTOUTS},
+            'offensive': {key: get_printout_value(po[prop]) or 0 for key, prop in OFFENSIVE_PRINTOUTS},
+            'defensive': {key: get_printout_value(po[prop]) or 0 for key, prop in DEFENSIVE_PRINTOUTS},
             'attributes': po['Monster attribute'] or [],
         }
 
+        # Apply any manual patches for monsters whose wiki data doesn't suit the calculator
+        overrides = MONSTER_OVERRIDES.get(
+            (monster['name'], monster['version']),
+            MONSTER_OVERRIDES.get(monster['name'], ())
+        )
+        for path, value in overrides:
+            apply_override(monster, path, value)
+
         weakness = get_printout_value(po['Elemental weakness']) or None
         if weakness:
             monster['weakness'] = {
@@ -198,61 +445,59 @@ def main():
             monster['weakness'] = None
 
         # Prune...
+        name_lower = monster['name'].lower()
         if (
                 # ...monsters that do not have any hitpoints
                 monster['skills']['hp'] == 0
                 # ...monsters that don't have an ID
                 or monster['id'] is None
-                # ...monsters that are historical
-                or '(historical)' in str.lower(monster['name'])
-                # ...monsters from the PvM arena
-                or '(pvm arena)' in str.lower(monster['name'])
-                # ...monsters from DMM Apocalypse
-                or '(deadman: apocalypse)' in str.lower(monster['name'])
+                # ...monsters that are historical, from the PvM arena, or from DMM Apocalypse
+                or any(s in name_lower for s in PRUNED_NAME_MARKERS)
         ):
             continue
 
         data.append(monster)
-        if not monster['image'] == '':
-            required_imgs.append(monster['image'])
+        if img := monster['image']:
+            required_imgs.add(img)
 
     print('Total monsters: ' + str(len(data)))
 
     # Save the JSON
-    with open(FILE_NAME, 'w') as f:
+    with open(FILE_NAME, 'wb') as f:
         print('Saving to JSON at file: ' + FILE_NAME)
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.write(dumps_json(data, indent=True))
 
-    success_img_dls = 0
-    failed_img_dls = 0
     skipped_img_dls = 0
-    required_imgs = set(required_imgs)
 
-    # Fetch all the images from the wiki and store them for local serving
+    # Work out which images need fetching from the wiki, so that they can be stored for local serving
+    existing_imgs = set(os.listdir(IMG_PATH))
     saved_image_paths = set()
-    for idx, img in enumerate(required_imgs):
+    todo = []
+    for img in required_imgs:
         dest_path = IMG_PATH + img
         if dest_path.lower() in saved_image_paths:
             print('[WARN] Case-sensitive image filename clashes: ' + dest_path)
             continue
 
         saved_image_paths.add(dest_path.lower())
-        if os.path.isfile(dest_path):
+        if img in existing_imgs:
             skipped_img_dls += 1
             continue
 
-        print(f'({idx}/{len(required_imgs)}) Fetching image: {img}')
-        r = requests.get(WIKI_BASE + '/w/Special:Filepath/' + img, headers={
-            'User-Agent': 'osrs-dps-calc (https://github.com/weirdgloop/osrs-dps-calc)'
-        })
-        if r.status_code == 200:
-            with open(dest_path, 'wb') as f:
-                f.write(r.content)
-                print('Saved image: ' + img)
-                success_img_dls += 1
-        else:
-            print('Unable to save image: ' + img)
-            failed_img_dls += 1
+        todo.append(img)
+
+    img_urls = dict(resolve_image_urls(todo))
+    for img in todo:
+        if img not in img_urls:
+            print('Unable to find image on the wiki: ' + img)
+
+    print(f'Fetching {len(img_urls)} images')
+    if aiohttp:
+        results = asyncio.run(download_all(img_urls.items()))
+    else:
+        results = download_all_threaded(img_urls.items())
+    success_img_dls = results.count(True)
+    failed_img_dls = results.count(False) + len(todo) - len(img_urls)
 
     print('Total images saved: ' + str(success_img_dls))
     print('Total images skipped (already exists): ' + str(skipped_img_dls))